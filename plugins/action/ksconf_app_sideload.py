@@ -8,12 +8,20 @@ from __future__ import absolute_import, division, print_function
 from typing import Tuple
 
 from ansible_collections.cdillc.splunk.plugins.module_utils.ksconf_shared import (
-    SIDELOAD_STATE_FILE, check_ksconf_version)
+    SIDELOAD_STATE_FILE, __version__ as collection_version,
+    check_ksconf_version, json_dumps, json_loads)
 
 
 __metaclass__ = type
 
+import fcntl
+import hashlib
 import os
+import re
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path, PurePosixPath
 
 from ansible.errors import AnsibleAction, AnsibleActionFail, AnsibleError
 from ansible.module_utils._text import to_text
@@ -21,34 +29,217 @@ from ansible.module_utils.parsing.convert_bool import boolean
 from ansible.plugins.action import ActionBase
 from ansible.utils.display import Display
 from ksconf.app.manifest import AppArchiveContentError, AppManifest, load_manifest_for_archive
+from ksconf.util.file import atomic_open
 
 
 display = Display()
 
+# Controller-side cache of archive manifests, keyed by the archive's path, size, and mtime
+MANIFEST_CACHE_DIR = "~/.cache/cdillc-splunk-ksconf-sideload"
+
+# Cache entries (and lock files) not written within this many seconds are pruned on save
+MANIFEST_CACHE_MAX_AGE = 30 * 86400
+
+# In-process memo (same key) to avoid re-reading the cache within a single worker
+MANIFEST_MEMO_SIZE = 128
+_MANIFEST_MEMO = OrderedDict()
+
+# Task arguments handled by this action, and not passed along to the module
+ACTION_ONLY_ARGS = frozenset(("decrypt", "recreate_manifest", "use_facts_cache"))
+
+# Resolved 'src' paths, keyed by the requested path and the task's search path
+_NEEDLE_MEMO = {}
+
+
+def get_sideload_fact_name(app_name: str) -> str:
+    """ Name of the host fact used to track the deployed hash of ``app_name`` """
+    return "cdillc_splunk_sideload_" + re.sub(r"\W", "_", app_name)
+
 
 class ActionModule(ActionBase):
 
     TRANSFERS_FILES = True
 
-    def fetch_remote_manifest(self, app_dir, task_vars, *,
-                              state_file=None,
-                              rebuild_manifest=True
-                              ) -> Tuple[AppManifest, dict]:
+    def _early_needs_tmp_path(self):
+        # Only create the remote tmpdir when the archive actually has to be transferred
+        return False
+
+    def fetch_remote_hash(self, app_dir, task_vars, *,
+                          state_file=None,
+                          rebuild_manifest=True
+                          ) -> Tuple[str, dict, dict]:
+        """ Fetch the hash of the deployed app's manifest (not the full manifest) """
         res = self._execute_module(module_name='cdillc.splunk.ksconf_app_manifest',
                                    module_args=dict(app_dir=app_dir,
                                                     state_file=state_file,
-                                                    rebuild_manifest=rebuild_manifest),
+                                                    rebuild_manifest=rebuild_manifest,
+                                                    hash_only=True),
                                    task_vars=task_vars)
-        manifest = state = None
-        if "manifest" in res:
-            manifest = res.pop("manifest")
-        if "state" in res:
-            state = res.pop("state")
-        if manifest:
-            manifest = AppManifest.from_dict(manifest)
+        remote_hash = res.pop("hash", None)
+        state = res.pop("state", None)
         for warning in res.get("warnings", []):
             display.warning(warning)
-        return manifest, state, res
+        return remote_hash, state, res
+
+    @staticmethod
+    def get_manifest_cache_file(archive: str) -> Path:
+        h = hashlib.new("sha256")
+        h.update(os.fsencode(archive))
+        cache_dir = Path(os.path.expanduser(MANIFEST_CACHE_DIR))
+        return cache_dir / f"{os.path.basename(archive)}-@-{h.hexdigest()[:32]}.json"
+
+    def load_cached_manifest(self, archive: str, stat: os.stat_result) -> AppManifest:
+        """
+        Return the cached manifest for ``archive``, or None if the cache is missing or stale.
+        Any change to the archive's size or mtime invalidates the cache entry.
+        """
+        cache_file = self.get_manifest_cache_file(archive)
+        try:
+            with open(cache_file, "rb") as cache_fp:
+                data = json_loads(cache_fp.read())
+        except (OSError, ValueError) as e:
+            display.vvvv(f"Unable to load manifest cache file {cache_file} due to {e}")
+            return None
+
+        if data.get("version") != collection_version or data.get("archive") != archive or \
+                data.get("size") != stat.st_size or data.get("mtime_ns") != stat.st_mtime_ns:
+            display.vvv(f"Ignoring stale manifest cache file {cache_file} for {archive}")
+            return None
+
+        try:
+            manifest = AppManifest.from_dict(data["manifest"])
+            if manifest.recalculate_hash():
+                raise ValueError("manifest failed internal hash consistency test")
+        except (AssertionError, KeyError, TypeError, ValueError) as e:
+            display.v(f"Ignoring unusable manifest cache file {cache_file} due to {e}")
+            return None
+        return manifest
+
+    def save_cached_manifest(self, archive: str, stat: os.stat_result, manifest: AppManifest) -> bool:
+        cache_file = self.get_manifest_cache_file(archive)
+        data = {
+            "archive": archive,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "version": collection_version,
+            "manifest": manifest.to_dict(),
+        }
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            # Atomic replace; concurrent writers (forks) for the same archive write identical content
+            with atomic_open(cache_file, ".tmp", "wb") as cache_fp:
+                cache_fp.write(json_dumps(data))
+        except OSError as e:
+            display.v(f"Unable to save manifest cache file {cache_file} due to {e}")
+            return False
+        self.prune_manifest_cache(cache_file)
+        return True
+
+    @staticmethod
+    def prune_manifest_cache(keep: Path):
+        """
+        Remove cache entries and lock files older than ``MANIFEST_CACHE_MAX_AGE``, except for
+        those of the cache entry ``keep`` (whose lock may be held by the caller).  Versioned archive
+        names (``app-1.2.3.tgz``) get a new entry per release, so old ones would otherwise pile up.
+        Pruning only runs after a cold manifest build, so it's rare.  Entries still in use are
+        simply rebuilt.
+        """
+        cutoff = time.time() - MANIFEST_CACHE_MAX_AGE
+        cache_dir = keep.parent
+        try:
+            entries = list(os.scandir(cache_dir))
+        except OSError as e:
+            display.vvvv(f"Unable to prune manifest cache {cache_dir} due to {e}")
+            return
+        for entry in entries:
+            if not entry.name.endswith((".json", ".lock")) or entry.name.startswith(keep.stem + "."):
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    display.vvvv(f"Pruned old manifest cache file {entry.path}")
+            except OSError:
+                pass
+
+    @contextmanager
+    def lock_manifest_cache(self, archive: str):
+        """
+        Hold an exclusive lock on the manifest cache entry for ``archive``.  This prevents every
+        worker (one per host) from building the same manifest in parallel on a cold cache.
+        """
+        lock_file = self.get_manifest_cache_file(archive).with_suffix(".lock")
+        try:
+            lock_file.parent.mkdir(parents=True, exist_ok=True)
+            lock_fp = open(lock_file, "a")
+        except OSError as e:
+            display.v(f"Unable to lock manifest cache file {lock_file} due to {e}")
+            yield
+            return
+        with lock_fp:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_fp, fcntl.LOCK_UN)
+
+    def find_source(self, source: str) -> str:
+        """ Memoized version of ``_find_needle('files', source)``.  Only successful lookups are kept. """
+        key = (source, tuple(self._task.get_search_path()))
+        real_source = _NEEDLE_MEMO.get(key)
+        if real_source is None:
+            real_source = _NEEDLE_MEMO[key] = self._find_needle("files", source)
+        return real_source
+
+    def get_local_source(self, real_source: str, decrypt=True) -> str:
+        """
+        Return a readable (decrypted, if vaulted) copy of ``real_source``.  This is deferred until
+        actually needed, as decrypting requires reading the entire archive.  Any decrypted
+        temporary copy is removed at the end of run().
+        """
+        if self._local_source is None:
+            try:
+                source = self._loader.get_real_file(real_source, decrypt=decrypt)
+            except AnsibleError as e:
+                raise AnsibleActionFail(to_text(e))
+            self._local_source = source
+        return self._local_source
+
+    def load_archive_manifest(self, real_source: str, stat: os.stat_result, decrypt=True) -> AppManifest:
+        """
+        Get the manifest for the local archive; using the in-process memo, then the controller
+        cache, and finally falling back to reading (and hashing) the archive itself.
+        """
+        memo_key = (real_source, stat.st_mtime_ns, stat.st_size)
+        app_manifest = _MANIFEST_MEMO.get(memo_key)
+        if app_manifest is not None:
+            _MANIFEST_MEMO.move_to_end(memo_key)
+            return app_manifest
+
+        app_manifest = self.load_cached_manifest(real_source, stat)
+        if app_manifest is None:
+            with self.lock_manifest_cache(real_source):
+                # Another worker may have built the manifest while we waited for the lock
+                app_manifest = self.load_cached_manifest(real_source, stat)
+                if app_manifest is None:
+                    source = self.get_local_source(real_source, decrypt)
+                    try:
+                        if source == real_source:
+                            # This writes a stored manifest along side `source` (when writable)
+                            app_manifest = load_manifest_for_archive(source)
+                        else:
+                            # Decrypted temporary copy.  A stored manifest is keyed on the mtime of
+                            # `source` and is therefore unusable.  Rely on the controller cache instead.
+                            app_manifest = AppManifest.from_archive(source)
+                            app_manifest.source = Path(real_source)
+                            app_manifest.check_paths()
+                    except AppArchiveContentError as e:
+                        raise AnsibleActionFail(f"Unable to process tarball {source} due to {e}")
+                    self.save_cached_manifest(real_source, stat, app_manifest)
+
+        _MANIFEST_MEMO[memo_key] = app_manifest
+        if len(_MANIFEST_MEMO) > MANIFEST_MEMO_SIZE:
+            _MANIFEST_MEMO.popitem(last=False)
+        return app_manifest
 
     def run(self, tmp=None, task_vars=None):
         ''' handler for app side-load operation '''
@@ -70,8 +261,10 @@ class ActionModule(ActionBase):
         recreate_manifest = boolean(self._task.args.get("recreate_manifest", True))
         decrypt = self._task.args.get('decrypt', True)
         list_files = self._task.args.get('list_files', False)
+        use_facts_cache = boolean(self._task.args.get("use_facts_cache", True))
 
         changed = True
+        self._local_source = None
         try:
 
             if source is None or dest is None:
@@ -83,23 +276,13 @@ class ActionModule(ActionBase):
             try:
                 # Q: Do we really want loose path finding behavior of _find_needle()?
                 #    It seems like the path should be typically known.
-                real_source = self._find_needle('files', source)
-                source = self._loader.get_real_file(real_source, decrypt=decrypt)
-
-                # Copy file timestamp as manifest process checks for mtime changes
+                real_source = self.find_source(source)
                 stat = os.stat(real_source)
-                os.utime(source, (stat.st_atime, stat.st_mtime))
-
-            except AnsibleError as e:
+            except (AnsibleError, OSError) as e:
                 raise AnsibleActionFail(to_text(e))
 
             # Get hash of local archive.  This is cached between runs to reduce overhead.
-            try:
-                # This requires writing to the controller's filesystem along side `source`
-                # Source should be relative to the real file (not the temporary decrypted one)
-                app_manifest = load_manifest_for_archive(source, permanent_archive=real_source)
-            except AppArchiveContentError as e:
-                raise AnsibleActionFail(f"Unable to process tarball {source} due to {e}")
+            app_manifest = self.load_archive_manifest(real_source, stat, decrypt)
 
             try:
                 '''
@@ -109,25 +292,35 @@ class ActionModule(ActionBase):
                 }
                 '''
                 # Pull back remote sideload state data, if present
-                # TODO: Check ansible facts first (Does this need an override parameter to skip?)
-                app_dir = os.path.join(dest, app_manifest.name)
-                if state_file:
-                    state_file = os.path.join(app_dir, state_file)
+                # These are remote (posix) paths; not local paths
+                app_dir = PurePosixPath(dest, app_manifest.name)
+                state_file = str(app_dir.joinpath(state_file or SIDELOAD_STATE_FILE))
+                app_dir = str(app_dir)
+
+                # Check ansible facts first; skipping the remote round-trip if this exact archive
+                # was already deployed (by a prior task in this play, or from the fact cache)
+                fact_name = get_sideload_fact_name(app_manifest.name)
+                deployed = task_vars.get("ansible_facts", {}).get(fact_name) if use_facts_cache else None
+                if isinstance(deployed, dict) and deployed.get("state_file") == state_file and \
+                        deployed.get("hash") == app_manifest.hash:
+                    display.vv(f"Skipping remote manifest check because fact {fact_name} "
+                               f"matches hash {app_manifest.hash}")
+                    installed_at = deployed.get("installed_at")
+                    changed = False
                 else:
-                    state_file = os.path.join(app_dir, SIDELOAD_STATE_FILE)
+                    remote_hash, remote_state, kam_res = self.fetch_remote_hash(
+                        app_dir, task_vars,
+                        state_file=state_file,
+                        rebuild_manifest=recreate_manifest)
 
-                remote_manifest, remote_state, kam_res = self.fetch_remote_manifest(
-                    app_dir, task_vars,
-                    state_file=state_file,
-                    rebuild_manifest=recreate_manifest)
+                    result["ksconf_app_manifest_output"] = kam_res
 
-                result["ksconf_app_manifest_output"] = kam_res
+                    if remote_hash:
+                        display.vvv(f"fCheck  {app_manifest.hash} == {remote_hash}")
 
-                if remote_manifest:
-                    display.vvv(f"fCheck  {app_manifest.hash} == {remote_manifest.hash}")
-
-                if remote_manifest and app_manifest.hash == remote_manifest.hash:
-                    changed = False
+                    if remote_hash and app_manifest.hash == remote_hash:
+                        installed_at = remote_state.get("installed_at", None)
+                        changed = False
 
             except AnsibleActionFail:
                 raise
@@ -140,21 +333,19 @@ class ActionModule(ActionBase):
 
             if changed:
                 # transfer the file to a remote tmp location
-                tmp_src = self._connection._shell.join_path(
-                    self._connection._shell.tmpdir, 'source')
-                self._transfer_file(source, tmp_src)
+                shell = self._connection._shell
+                tmpdir = shell.tmpdir or self._make_tmp_path()
+                tmp_src = shell.join_path(tmpdir, 'source')
+                self._transfer_file(self.get_local_source(real_source, decrypt), tmp_src)
 
                 # handle diff mode client side
                 # handle check mode client side
 
                 # remove action plugin only keys
-                new_module_args = self._task.args.copy()
-                for key in ('decrypt', 'recreate_manifest'):
-                    if key in new_module_args:
-                        del new_module_args[key]
+                new_module_args = {k: v for k, v in self._task.args.items() if k not in ACTION_ONLY_ARGS}
 
                 # fix file permissions when the copy is done as a different user
-                self._fixup_perms2((self._connection._shell.tmpdir, tmp_src))
+                self._fixup_perms2((tmpdir, tmp_src))
                 new_module_args['src'] = tmp_src
 
                 # Pass the original 'src' field over to the module (for logging)
@@ -169,23 +360,40 @@ class ActionModule(ActionBase):
                     result["manifest_msg"] += f" after manifest was {kam_res['result']}"
 
             else:
-                # Simulate the output of the ksconf_app_sideload module
+                # Simulate the output of the ksconf_app_sideload module.
+                # Matching hashes means the local and remote manifests are identical.
                 result["changed"] = False
                 result["state_file"] = state_file
-                result["hash"] = remote_manifest.hash
-                result["installed_at"] = remote_state.get("installed_at", None)
+                result["hash"] = app_manifest.hash
+                result["installed_at"] = installed_at
                 result["app_info"] = {
-                    "name": remote_manifest.name,
+                    "name": app_manifest.name,
                     "deprecated": "NOTE 'app_info' is going away, use 'app_facts' instead!"}
-                result["app_facts"] = {"name": remote_manifest.name}
+                result["app_facts"] = {"name": app_manifest.name}
 
                 # Note that this version does NOT include directories.
                 # Trying to match the 'list_files' behavior of the builtin unarchive module.)
                 if list_files:
-                    result["files"] = [os.fspath(f.path) for f in remote_manifest.files]
+                    result["files"] = [os.fspath(f.path) for f in app_manifest.files]
+
+            if not result.get("failed"):
+                result["ansible_facts"] = {
+                    fact_name: {
+                        "hash": app_manifest.hash,
+                        "state_file": state_file,
+                        "installed_at": result.get("installed_at"),
+                    }
+                }
 
         except AnsibleAction as e:
             result.update(e.result)
         finally:
+            if self._local_source is not None:
+                # Remove decrypted temporary copy (no-op for an unencrypted source)
+                self._loader.cleanup_tmp_file(self._local_source)
+            # Because _early_needs_tmp_path() returns False, a remote tmpdir only exists if one was
+            # created for the archive transfer above, or by _execute_module() when pipelining is
+            # disabled.  When shell.tmpdir is None this is a no-op (no remote command).
+            # Must stay unconditional so that either tmpdir is cleaned up.
             self._remove_tmp_path(self._connection._shell.tmpdir)
         return result
@@ -18,7 +18,6 @@ from io import StringIO
 from pathlib import Path, PurePath
 
 from ansible.errors import AnsibleError
-from ansible.module_utils._text import to_text
 from ansible.module_utils.parsing.convert_bool import boolean
 from ansible.parsing.vault import VaultEditor, VaultLib, b_HEADER as VAULT_HEADER
 from ansible.plugins.action import ActionBase
@@ -26,7 +25,8 @@ from ansible.template import Templar
 from ansible.utils.display import Display
 
 from ansible_collections.cdillc.splunk.plugins.module_utils.ksconf_shared import (
-    __version__ as collection_version, check_ksconf_version, temp_decrypt)
+    __version__ as collection_version, check_ksconf_version,
+    hash_manifest_files, json_dumps, json_loads, temp_decrypt)
 
 
 display = Display()
@@ -37,6 +37,9 @@ JINJA_HANDLERS = ["ansible", "ansible-jinja"]
 # For now this is the same
 TEMPLATE_HANDLERS = JINJA_HANDLERS
 
+# Matches ksconf '[[var]]' style variables
+KSCONF_VAR_RE = re.compile(r'\[\[(\s*[\w_]+\s*)\]\]')
+
 
 ksconf_min_version = (0, 13, 8)
 ksconf_min_version_text = ".".join(f"{i}" for i in ksconf_min_version)
@@ -93,17 +96,22 @@ class LayerFile_AnsibleJinja2(LayerRenderedFile):
 
     @property
     def templar(self) -> Templar:
-        # Use context object to 'cache' the templar
-        if not hasattr(self.layer.context, "ansible_templar"):
-            self.layer.context.ansible_templar = self._build_templar()
-        return self.layer.context.ansible_templar
+        # Use context object to 'cache' the templar.  One per layer, as the search path is layer-specific
+        templars = getattr(self.layer.context, "ansible_templars", None)
+        if templars is None:
+            templars = self.layer.context.ansible_templars = {}
+        root = os.fspath(self.layer.root)
+        templar = templars.get(root)
+        if templar is None:
+            templar = templars[root] = self._build_templar()
+        return templar
 
     def _build_templar(self):
         updates = {
             "searchpath": [os.fspath(self.layer.root)]
         }
         if self.layer.context.template_variables:
-            updates["available_variables"] = self.layer.context.template_variable
+            updates["available_variables"] = self.layer.context.template_variables
         # TODO: Should we offer some standard variables?  Something as simple as 'app_name' can be super helpful
         #       to avoid hard dependencies on the folder name of an app.
         templar = self._templar.copy_with_new_env(**updates)
@@ -114,7 +122,11 @@ class LayerFile_AnsibleJinja2(LayerRenderedFile):
         # of 'template_*' variables (like path/mtime/host).  These tend to interfere with
         # idempotent behavior so not a big loss)
         display.vv(f"Decrypting {template_path} which will become {self.logical_path}")
-        template = template_path.read_text()
+        b_template = template_path.read_bytes()
+        if b"\r" in b_template:
+            # Same newline handling as text mode (universal newlines)
+            b_template = b_template.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        template = b_template.decode("utf-8")
         value = self.templar.do_template(template, escape_backslashes=False)
 
         validate_rendered(self.logical_path, template_path, value)
@@ -189,7 +201,7 @@ def translate_ksconf_vars(value):
         {% raw %}{{ var }}{% endraw %}
     """
     if value:
-        return re.sub(r'\[\[(\s*[\w_]+\s*)\]\]', r"{{\1}}", value)
+        return KSCONF_VAR_RE.sub(r"{{\1}}", value)
     return value
 
 
@@ -258,10 +270,10 @@ class ActionModule(ActionBase):
         display.vvv(f"Cache data to {cache_file} with content:  {cache_data!r}")
 
         try:
-            with atomic_open(cache_file, ".tmp", "w") as cache_fp:
+            with atomic_open(cache_file, ".tmp", "wb") as cache_fp:
                 # TODO: indent only if debug/verbose level is set... (need to lookup how to do that)
                 #       display.verbosity > 1  ?
-                json.dump(cache_data, cache_fp, indent=2)
+                cache_fp.write(json_dumps(cache_data, pretty=True))
         except IOError as e:
             display.v(f"Unable to save cache file at:  {cache_file} due to {e}")
             return False
@@ -272,8 +284,8 @@ class ActionModule(ActionBase):
                               collection: LayerCollectionBase) -> dict:
         try:
             display.vvvv(f"Loading cache from file {cache_file}")
-            with open(cache_file) as cache_fp:
-                cache_data = json.load(cache_fp)
+            with open(cache_file, "rb") as cache_fp:
+                cache_data = json_loads(cache_fp.read())
         except IOError as e:
             display.vvv(f"Unable to load cache file at:  {cache_file} due to {e}")
             return {}
@@ -418,8 +430,13 @@ class ActionModule(ActionBase):
 
         layer_context = LayerContext(follow_symlink=follow_symlink,
                                      template_variables=template_vars)
-        layer_filters = [(mode, pattern) for layer in layers
-                         for mode, pattern in layer.items() if pattern]
+        layer_filters = []
+        layers_used = []
+        for layer in layers:
+            for mode, pattern in layer.items():
+                if pattern:
+                    layer_filters.append((mode, pattern))
+                    layers_used.append({mode: pattern})
 
         layer_collection = build_layer_collection(
             source,
@@ -471,9 +488,9 @@ class ActionModule(ActionBase):
 
                 end_time = datetime.datetime.now()
                 delta = end_time - start_time
-                result["start"] = to_text(start_time)
-                result["end"] = to_text(end_time)
-                result["delta"] = to_text(delta)
+                result["start"] = str(start_time)
+                result["end"] = str(end_time)
+                result["delta"] = str(delta)
 
                 stats["ksconf_package_action_" + result['action']] = 1
                 stats["ksconf_package_time_cached"] = delta.total_seconds()
@@ -530,7 +547,9 @@ class ActionModule(ActionBase):
             # Check manifest of existing 'dest' archive to enable idempotent operation
             archive_path = Path(packager.expand_var(dest))
 
-            new_manifest = packager.make_manifest(calculate_hash=True)
+            # ksconf builds the file listing; the file content is hashed concurrently
+            new_manifest = packager.make_manifest(calculate_hash=False)
+            hash_manifest_files(new_manifest, packager.app_dir)
             existing_manifest = None
             result["encryption"] = "false"
             decrypted_size = None
@@ -612,16 +631,17 @@ class ActionModule(ActionBase):
             result["cache"] = "created" if cache_new else "updated"
 
         # Fixup the 'layers' output (invocation/module_args/layers); drop empty
-        params["layers"] = [{mode: pattern} for layer in layers
-                            for mode, pattern in layer.items() if pattern]
+        params["layers"] = layers_used
 
         end_time = datetime.datetime.now()
         delta = end_time - start_time
 
-        result["start"] = to_text(start_time)
-        result["end"] = to_text(end_time)
-        result["delta"] = to_text(delta)
-        result["stdout"] = to_text(log_stream.getvalue())
+        result["start"] = str(start_time)
+        result["end"] = str(end_time)
+        result["delta"] = str(delta)
+        # Only return the (potentially long) packaging log when the archive was written, as documented
+        if resulting_action != "unchanged" or display.verbosity >= 2:
+            result["stdout"] = log_stream.getvalue()
 
         stats["ksconf_package_action_" + result['action']] = 1
         stats["ksconf_package_time_packaging"] = delta.total_seconds()
@@ -23,6 +23,8 @@ DOCUMENTATION = '''
           fields to the screen, as is.
         - Setting the 'no_log' directive on a task will hide it from the output entirely.
         - Failures and warnings are still displayed.  These are borrowed from the 'minimal' callback plugin.
+          Failures with C(stdout), C(stderr), or C(msg) are shown as-is; otherwise, or when running with C(-v)
+          or higher, the full result is shown as JSON.
 '''
 
 
@@ -37,63 +39,73 @@ class CallbackModule(CallbackBase):
     CALLBACK_TYPE = 'stdout'
     CALLBACK_NAME = 'asis'
 
+    @staticmethod
+    def _as_text_block(value) -> str:
+        """ Render a value (or list of lines) as text, terminated with a newline if non-empty """
+        if isinstance(value, (list, tuple)):
+            return "\n".join(str(i) for i in value) + "\n"
+        value = str(value)
+        if value and not value.endswith("\n"):
+            return value + "\n"
+        return value
+
+    def _has_text_output(self, result) -> bool:
+        """
+        Can this result be shown as-is?  Module crashes and loop results still need the full dump,
+        as does any result at -v or higher (so structured data like 'status' or 'json' is kept).
+        """
+        return self._display.verbosity < 1 and \
+            any(result.get(key) for key in ("stdout", "stderr", "msg")) and \
+            "module_stderr" not in result and "results" not in result
+
     def _command_generic_msg(self, host, result, caption):
         ''' output the result of a command run '''
         # TODO:  Add some kind of indentation here (defaults to 4 elsewhere)
-        buf = ["%s | %s | rc=%s >>\n" % (host, caption, result.get('rc', -1))]
-
-        def add(s):
-            if isinstance(s, (list, tuple)):
-                buf.append("\n".join(str(i) for i in s) + "\n")
-                return
-            s = str(s)
-            buf.append(s)
-            if s and isinstance(s, str) and not s.endswith("\n"):
-                buf.append("\n")
-
-        add(result.get('stdout', ''))
-        add(result.get('stderr', ''))
-        add(result.get('msg', ''))
-        return "".join(buf)
+        block = self._as_text_block
+        return (f"{host} | {caption} | rc={result.get('rc', -1)} >>\n"
+                f"{block(result.get('stdout', ''))}"
+                f"{block(result.get('stderr', ''))}"
+                f"{block(result.get('msg', ''))}")
 
     def v2_runner_on_failed(self, result, ignore_errors=False):
+        r = result._result
+        host = result._host.get_name()
 
-        self._handle_exception(result._result)
-        self._handle_warnings(result._result)
+        self._handle_exception(r)
+        self._handle_warnings(r)
 
-        if result._task.action in C.MODULE_NO_JSON and 'module_stderr' not in result._result:
-            self._display.display(self._command_generic_msg(result._host.get_name(),
-                                                            result._result, "FAILED"),
+        if (result._task.action in C.MODULE_NO_JSON and 'module_stderr' not in r) or \
+                self._has_text_output(r):
+            self._display.display(self._command_generic_msg(host, r, "FAILED"),
                                   color=C.COLOR_ERROR)
         else:
-            self._display.display("%s | FAILED! => %s" % (result._host.get_name(),
-                                                          self._dump_results(result._result, indent=4)),
+            self._display.display("%s | FAILED! => %s" % (host, self._dump_results(r, indent=4)),
                                   color=C.COLOR_ERROR)
 
     def v2_runner_on_ok(self, result):
-        self._clean_results(result._result, result._task.action)
+        r = result._result
+        host = result._host.get_name()
+        self._clean_results(r, result._task.action)
 
-        self._handle_warnings(result._result)
+        self._handle_warnings(r)
 
-        # self._display.display(f"{result._host.get_name()}\n{result._result.get('stdout')}")
-        if result._result.get('changed', False):
+        # self._display.display(f"{host}\n{r.get('stdout')}")
+        if r.get('changed', False):
             color = C.COLOR_CHANGED
             state = 'CHANGED'
         else:
             color = C.COLOR_OK
             state = 'SUCCESS'
 
-        priority_msg = result._result.get("priority_msg", "")
-        censored = result._result.get("censored", "")
+        priority_msg = r.get("priority_msg", "")
+        censored = r.get("censored", "")
         if "no_log" in censored:
             # NO output
             pass
         elif priority_msg:
             self._display.display(priority_msg, color=color)
         else:
-            self._display.display(self._command_generic_msg(result._host.get_name(),
-                                                            result._result, state),
-                                  color=color)
+            self._display.display(self._command_generic_msg(host, r, state), color=color)
 
         '''
         if result._task.action in C.MODULE_NO_JSON and 'ansible_job_id' not in result._result:
@@ -108,8 +120,13 @@ class CallbackModule(CallbackBase):
         self._display.display("%s | SKIPPED" % (result._host.get_name()), color=C.COLOR_SKIP)
 
     def v2_runner_on_unreachable(self, result):
-        self._display.display("%s | UNREACHABLE! => %s" % (result._host.get_name(
-        ), self._dump_results(result._result, indent=4)), color=C.COLOR_UNREACHABLE)
+        if self._has_text_output(result._result):
+            self._display.display(self._command_generic_msg(result._host.get_name(),
+                                                            result._result, "UNREACHABLE!"),
+                                  color=C.COLOR_UNREACHABLE)
+        else:
+            self._display.display("%s | UNREACHABLE! => %s" % (result._host.get_name(
+            ), self._dump_results(result._result, indent=4)), color=C.COLOR_UNREACHABLE)
 
     def v2_on_file_diff(self, result):
         if 'diff' in result._result and result._result['diff']:
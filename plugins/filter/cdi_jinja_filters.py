@@ -1,7 +1,22 @@
-import re
-from datetime import timedelta
+from functools import lru_cache
 
 
+# Strongly borrowed from cypresspoint.datatype.reltime_to_timedelta.
+# Copied not referenced to avoid additional runtime dependencies.
+# Grammar:  <digits>[mon|d|h|m|s|w|y]  (any trailing text is ignored)
+RELTIME_UNITS = frozenset("dhmswy")
+RELTIME_UNIT_SECONDS = {
+    "s": 1,
+    "m": 60,
+    "h": 60 * 60,
+    "d": 24 * 60 * 60,
+    "w": 7 * 24 * 60 * 60,
+    "mon": 30 * 24 * 60 * 60,
+    "y": 365 * 24 * 60 * 60,
+}
+
+
+@lru_cache(maxsize=256)
 def reltime_to_sec(value):
     """Convert a relative time expression into a number of seconds.
 
@@ -13,40 +28,22 @@ def reltime_to_sec(value):
 
     :param value: Relative time expression
     :type value: str
-    :return: python object representation of the given relative time
-    :rtype: float
+    :return: number of seconds
+    :rtype: int
     """
-    # Strongly borrowed from cypresspoint.datatype.reltime_to_timedelta.
-    # Copied not referenced to avoid additional runtime dependencies.
-    pattern = re.compile(r"(\d+)(mon|[dhmswy]?)")
-    suffix_map = {
-        "s": "seconds",
-        "m": "minutes",
-        "h": "hours",
-        "d": "days",
-        "w": "weeks",
-    }
-    suffix_day_multiplier = {
-        "y": 365,
-        "mon": 30,
-    }
-    m = pattern.match(value)
-    if m is None:
+    rest = value.lstrip("0123456789")
+    if len(rest) == len(value):
         raise ValueError("Unsupported span value: '{0}'  "
                          "Supports formats like '3y', '6mon', '3w', '7d', "
                          "'2h' and '15m'".format(value))
-    v, suffix = m.groups()
-    try:
-        v = int(v)
-    except ValueError:
-        raise ValueError("Unsupported value: '{0}'".format(value))
-    if not suffix:
+    v = int(value[:len(value) - len(rest)])
+    if rest.startswith("mon"):
+        suffix = "mon"
+    elif rest[:1] in RELTIME_UNITS:
+        suffix = rest[0]
+    else:
         suffix = "s"
-    td_arg = suffix_map.get(suffix, "days")
-    multiplier = suffix_day_multiplier.get(suffix, 1)
-    kwargs = {td_arg: v * multiplier}
-    delta = timedelta(**kwargs)
-    return int(delta.total_seconds())
+    return v * RELTIME_UNIT_SECONDS[suffix]
 
 
 class FilterModule:
@@ -4,19 +4,34 @@ from __future__ import absolute_import, division, print_function
 
 __metaclass__ = type
 
+import hashlib
+import json
+import mmap
 import os
 import re
+import tempfile
+import threading
 from contextlib import contextmanager
-from pathlib import Path
-from random import randint
+from functools import lru_cache
+from pathlib import Path, PurePosixPath
 
 from ansible.module_utils.basic import AnsibleModule
 
 
+try:
+    # Optional; significantly faster for large manifests
+    import orjson
+except ImportError:
+    orjson = None
+
+
 __version__ = "0.26.1"
 
 SIDELOAD_STATE_FILE = ".ksconf_sideload.json"
 
+# State files are written as compact JSON unless KSCONF_STATE_PRETTY=1 (for human-readable diffs)
+STATE_FILE_PRETTY = os.environ.get("KSCONF_STATE_PRETTY") == "1"
+
 # Traditional Splunk home (install paths)
 SPLUNK_HOME_PATH = [
     "/opt/splunk",
@@ -25,6 +40,25 @@ SPLUNK_HOME_PATH = [
 ]
 
 
+def json_loads(data):
+    """ Parse JSON from str or bytes.  Raises ValueError (or a subclass) on bad input. """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj, pretty=False) -> bytes:
+    """ Serialize ``obj`` to compact UTF-8 encoded JSON.  Use a 2 space indent when ``pretty`` is enabled. """
+    if orjson:
+        option = orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    if pretty:
+        return json.dumps(obj, indent=2).encode("utf-8")
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
 def find_splunk_home():
     """ Find an appropriate value for SPLUNK_HOME.
 
@@ -33,33 +67,54 @@ def find_splunk_home():
     go with *any* match against the well known splunk home list.
 
     Multiple splunk installations are not explicitly supported.
+
+    The result is cached for the life of the process (per $SPLUNK_HOME value).
     """
-    if "SPLUNK_HOME" in os.environ:
-        path = os.environ["SPLUNK_HOME"]
-        if os.path.isdir(path):
-            return path
+    return _find_splunk_home(os.environ.get("SPLUNK_HOME"))
+
+
+@lru_cache(maxsize=None)
+def _find_splunk_home(env_splunk_home):
+    if env_splunk_home is not None:
+        if os.path.isdir(env_splunk_home):
+            return env_splunk_home
 
-    # Check popular paths
+    # Check popular paths.  Each candidate directory is only stat'ed once.
+    discovery_paths = [path for path in SPLUNK_HOME_PATH if os.path.isdir(path)]
     for known_path in ("bin/splunk", "etc/splunk.version", None):
-        path = _guess_splunk_home(SPLUNK_HOME_PATH, known_path)
+        path = _guess_splunk_home(discovery_paths, known_path)
         if path:
             return path
     return None
 
 
 def _guess_splunk_home(discovery_paths, test_file):
+    """ Return the first of ``discovery_paths`` (existing directories) containing ``test_file``, if given """
     for path in discovery_paths:
-        if os.path.isdir(path):
-            if test_file:
-                test_path = os.path.join(path, test_file)
-                if os.path.isfile(test_path):
-                    return path
-            else:
+        if test_file:
+            test_path = os.path.join(path, test_file)
+            if os.path.isfile(test_path):
                 return path
+        else:
+            return path
     return None
 
 
+KSCONF_VERSION_RE = re.compile(r'(\d+)\.(\d+)\.(\d+)(.*)$')
+
+# Parsed ksconf version; cached as it can't change within a process
+_ksconf_version = None
+
+
 def check_ksconf_version(module: AnsibleModule = None) -> tuple:
+    global _ksconf_version
+    if _ksconf_version is not None:
+        return _ksconf_version
+    _ksconf_version = _check_ksconf_version(module)
+    return _ksconf_version
+
+
+def _check_ksconf_version(module: AnsibleModule = None) -> tuple:
     if not module:
         from ansible.errors import AnsibleActionFail
         from ansible.utils.display import Display
@@ -79,7 +134,7 @@ def check_ksconf_version(module: AnsibleModule = None) -> tuple:
             else:
                 raise AnsibleActionFail(message=message)
 
-    match = re.match(r'(\d+)\.(\d+)\.(\d+)(.*)$', ksconf_version)
+    match = KSCONF_VERSION_RE.match(ksconf_version)
     if match:
         p = match.groups()
         return int(p[0]), int(p[1]), int(p[2]), p[3]
@@ -92,6 +147,119 @@ def check_ksconf_version(module: AnsibleModule = None) -> tuple:
         return 0, 0, 0, ksconf_version
 
 
+# Per-thread read buffer for file_hash() (reused across files)
+_hash_buffers = threading.local()
+
+# Files at least this large are hashed via mmap (avoids copying into a userspace buffer)
+MMAP_HASH_THRESHOLD = 4 * 1024 * 1024
+
+
+def file_hash(path, algorithm: str = "sha256", buffer_size: int = 1024 * 1024, *,
+              size: int = None) -> str:
+    """ Return the hex digest of ``path`` using the hashlib ``algorithm``, read in chunks of
+    ``buffer_size`` bytes.  Pass ``size`` when the file size is already known to skip an extra
+    ``fstat()``.
+    """
+    with open(path, "rb", buffering=0) as f:
+        if size is None:
+            size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_HASH_THRESHOLD:
+            digest = _mmap_hash(f, algorithm)
+            if digest:
+                return digest
+        if hasattr(os, "posix_fadvise"):
+            # Hint the kernel to read ahead aggressively
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if hasattr(hashlib, "file_digest"):
+            # Python 3.11+:  read/update loop runs in C
+            return hashlib.file_digest(f, algorithm).hexdigest()
+        buf = getattr(_hash_buffers, "buf", None)
+        if buf is None or len(buf) != buffer_size:
+            buf = _hash_buffers.buf = bytearray(buffer_size)
+        view = memoryview(buf)
+        h = hashlib.new(algorithm)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def _mmap_hash(f, algorithm: str) -> str:
+    """ Hash an open file via mmap.  Returns None if the file can't be mapped. """
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    with mm:
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        return hashlib.new(algorithm, mm).hexdigest()
+
+
+def _scan_files(top: str, rel_root: PurePosixPath = PurePosixPath()):
+    """ Yield ``(relative_path, DirEntry)`` for each file under ``top``.
+
+    Traversal matches ``os.walk(top)``:  files before subdirectories, symlinked
+    directories are not followed, and unreadable directories are skipped.
+    """
+    subdirs = []
+    try:
+        scanner = os.scandir(top)
+    except OSError:
+        return
+    with scanner:
+        for entry in scanner:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                yield rel_root.joinpath(entry.name), entry
+            elif not entry.is_symlink():
+                subdirs.append(entry)
+    for entry in subdirs:
+        yield from _scan_files(entry.path, rel_root.joinpath(entry.name))
+
+
+def hash_manifest_files(manifest, path, *, max_workers=None):
+    """
+    Fill in the hash of each file in ``manifest`` (as built with ``calculate_hash=False``) from
+    the app directory ``path``.  Files are hashed concurrently with ``manifest.hash_algorithm``.
+    (hashlib releases the GIL for large buffers)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    root = os.fspath(path)
+    with ThreadPoolExecutor(max_workers) as executor:
+        hashes = executor.map(
+            lambda f: file_hash(os.path.join(root, *f.path.parts), manifest.hash_algorithm,
+                                size=f.size),
+            manifest.files)
+        for f, digest in zip(manifest.files, hashes):
+            f.hash = digest
+    return manifest
+
+
+def build_manifest_from_filesystem(path, name=None, *, filter_file=None, max_workers=None):
+    """
+    Build an app manifest for the directory ``path``.  This is equivalent to
+    ``AppManifest.from_filesystem(path, name, calculate_hash=True, filter_file=filter_file)``,
+    except that files are hashed concurrently.  (See hash_manifest_files())
+    """
+    from ksconf.app.manifest import AppManifest, AppManifestFile
+
+    path = Path(path)
+    manifest = AppManifest(name or path.name, source=path)
+    for (rel_path, entry) in _scan_files(os.fspath(path)):
+        if filter_file is not None and not filter_file(rel_path):
+            continue
+        st = entry.stat()
+        manifest.files.append(AppManifestFile(rel_path, st.st_mode & 0o777, st.st_size))
+    return hash_manifest_files(manifest, path, max_workers=max_workers)
+
+
 @contextmanager
 def temp_decrypt(encrypted_file: Path, vault, *, clone_mtime=False, log_callback=None):
     from ansible.parsing.vault import VaultEditor
@@ -100,11 +268,18 @@ def temp_decrypt(encrypted_file: Path, vault, *, clone_mtime=False, log_callback
         def log_callback(s): pass
 
     vault_editor = VaultEditor(vault)
-    decrypted_file = encrypted_file.with_name(encrypted_file.name +
-                                              f".decrypted-{os.getpid()}-{randint(0, 999999)}")
-    assert not decrypted_file.is_file()
+    # mkstemp() atomically creates the file (mode 0600); VaultEditor writes directly to the fd
+    fd, decrypted_path = tempfile.mkstemp(prefix=encrypted_file.name + ".decrypted-",
+                                          dir=encrypted_file.parent)
+    decrypted_file = Path(decrypted_path)
     log_callback(f"temp_decrypt:  Decrypting vault file {encrypted_file} -> {decrypted_file}")
-    vault_editor.decrypt_file(encrypted_file, decrypted_file)
+    try:
+        vault_editor.decrypt_file(encrypted_file, fd)
+    except Exception:
+        decrypted_file.unlink()
+        raise
+    finally:
+        os.close(fd)
     if clone_mtime:
         stat = encrypted_file.stat()
         os.utime(decrypted_file, (stat.st_atime, stat.st_mtime))
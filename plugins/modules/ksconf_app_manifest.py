@@ -6,26 +6,24 @@
 
 Eventually this module should be expanded to support:
 
-1.) Fast hash check.   No need to return the entire payload if the hash matches on the target
-2.) Check for differences.   Report which (if any) files vary from the known manifest.
-3.) Check against an explicit manifest???  (needs more consideration)
+1.) Check for differences.   Report which (if any) files vary from the known manifest.
+2.) Check against an explicit manifest???  (needs more consideration)
 
 """
 
 from __future__ import absolute_import, division, print_function
 
-import json
 import os
 import time
 from contextlib import suppress
-from pathlib import Path
-from typing import TYPE_CHECKING, Any, Tuple
+from typing import Tuple
 
 from ansible.module_utils.basic import AnsibleModule
 
 from ansible_collections.cdillc.splunk.plugins.module_utils.ksconf_shared import (
-    SIDELOAD_STATE_FILE, __version__ as collection_version,
-    check_ksconf_version)
+    SIDELOAD_STATE_FILE, STATE_FILE_PRETTY, __version__ as collection_version,
+    build_manifest_from_filesystem, check_ksconf_version, json_dumps,
+    json_loads)
 
 
 try:
@@ -34,10 +32,11 @@ except ImportError:
     from ksconf._version import version as ksconf_version
 
 
-if TYPE_CHECKING:
+try:
     from ksconf.app.manifest import AppManifest
-else:
-    AppManifest = Any
+except ImportError:
+    # Too old; reported by check_ksconf_version() in main()
+    AppManifest = None
 
 
 __metaclass__ = type
@@ -48,6 +47,13 @@ ksconf_warn_version = (0, 13, 4)
 ksconf_min_version_text = ".".join(f"{i}" for i in ksconf_min_version)
 ksconf_warn_version_text = ".".join(f"{i}" for i in ksconf_warn_version)
 
+# Fixed values recorded in every state file written by write_app_state()
+_STATE_CONSTS = {
+    "ansible_module_version": collection_version,
+    "ksconf_version": ksconf_version,
+    "rebuilt_from_filesystem": True,
+}
+
 
 DOCUMENTATION = r'''
 ---
@@ -81,13 +87,20 @@ options:
         - This requires ksconf v0.13.5, or this feature will be ignored.
     type: bool
     default: true
+  hash_only:
+    description:
+        - Return only the manifest I(hash) instead of the full I(manifest).
+        - This greatly reduces the amount of data returned for apps with many files.
+    type: bool
+    default: false
 
 extends_documentation_fragment:
     - action_common_attributes
 
 attributes:
   check_mode:
-    support: none
+    support: full
+    details: The state file is never written in check mode, even when I(rebuild_manifest) is enabled.
   diff_mode:
     support: none
   platform:
@@ -142,7 +155,8 @@ result:
     - C(loaded) when state & manifest successfully loaded from I(state_file),
     - C(created) when state file was created from scratch,
     - C(rebuilt) when existing state file was updated with new manifest, or
-    - C(no-manifest) when the manifest could not be loaded and I(rebuild_manifest) is false.
+    - C(no-manifest) when the manifest could not be loaded and I(rebuild_manifest) is false, or
+    - C(check-would-rebuild) when the manifest would be built, but check mode is enabled.
     - >
       Any of the follows indicate a failure:
     - C(no-app) when the I(app_dir) is missing,
@@ -154,9 +168,14 @@ manifest:
   description: >
     Manifest objects.
     See L(AppManifest,https://ksconf.readthedocs.io/en/latest/api/ksconf.app.html#ksconf.app.manifest.AppManifest)
-  returned: when manifest is present or built
+  returned: when manifest is present or built, unless I(hash_only) is enabled
   type: dict
 
+hash:
+  description: Manifest hash
+  returned: when manifest is present or built, and I(hash_only) is enabled
+  type: str
+
 state:
   description: State of the state file / manifest
   returned: on success
@@ -165,14 +184,13 @@ state:
 '''
 
 
-def get_app_manifest(state_file: Path) -> Tuple[AppManifest, dict, str]:
-    from ksconf.app.manifest import AppManifest
+def get_app_manifest(state_file: str) -> Tuple[AppManifest, dict, str]:
     try:
-        with open(state_file) as fp:
+        with open(state_file, "rb") as fp:
             try:
-                state_data = json.load(fp)
+                state_data = json_loads(fp.read())
             except ValueError:
-                # Or json.decoder.JSONDecodeError?
+                # JSONDecodeError, or UnicodeDecodeError for non-UTF-8 content
                 return None, None, "corrupted"
             if "manifest" in state_data:
                 return AppManifest.from_dict(state_data.pop("manifest")), state_data, "present"
@@ -182,39 +200,22 @@ def get_app_manifest(state_file: Path) -> Tuple[AppManifest, dict, str]:
         return None, None, "missing"
 
 
-def build_app_manifest(app_dir: Path, state_file: Path,
+def build_app_manifest(app_dir: str, state_file: str,
                        discard_local_app_autogen=True) -> AppManifest:
     """ Build a new app manifest for an existing app directory. """
-    from ksconf.app.manifest import AppManifest
-
-    if state_file.exists():
-        try:
-            rel_statefile = state_file.relative_to(app_dir)
-            def filter_state_file(path): return path != rel_statefile
-        except ValueError:
-            # State file not stored within the app directory.  Nothing to filter out
-            # NOTE: Can't use is_relative_to(); added in Python 3.9, still supporting 3.8
-            filter_state_file = None
-    else:
-        # No existing state file; nothing to filter (other deployment mechanism, or alternate state_file location?)
+    # Pure path comparison (no stat needed).  If the state file doesn't exist yet,
+    # filtering it out is harmless.
+    rel_statefile = os.path.relpath(state_file, app_dir)
+    if rel_statefile == os.pardir or rel_statefile.startswith(os.pardir + os.sep):
+        # State file not stored within the app directory.  Nothing to filter out
         filter_state_file = None
+    else:
+        excluded = frozenset((rel_statefile,))
+        def filter_state_file(path): return os.fspath(path) not in excluded
 
-    try:
-        # Ksconf v0.13.4 adds 'filter_file' argument
-        manifest = AppManifest.from_filesystem(app_dir, calculate_hash=True,
-                                               filter_file=filter_state_file)
-    except TypeError:
-        # Older ksconf.  Simply move manifest up a directory and restore when done.
-        try:
-            if state_file.exists():
-                temp_state = app_dir.parent.joinpath(f".{app_dir.name}.ksconf-manifest-rebuild.tmp")
-                state_file.replace(temp_state)
-            else:
-                temp_state = None
-            manifest = AppManifest.from_filesystem(app_dir, calculate_hash=True)
-        finally:
-            if temp_state:
-                temp_state.replace(state_file)
+    # Files are hashed concurrently; this also supports 'filter_file' regardless of ksconf version
+    manifest = build_manifest_from_filesystem(app_dir, filter_file=filter_state_file,
+                                              max_workers=min(8, os.cpu_count() or 1))
 
     if discard_local_app_autogen:
         with suppress(AttributeError):
@@ -223,7 +224,7 @@ def build_app_manifest(app_dir: Path, state_file: Path,
     return manifest
 
 
-def write_app_state(state_file: Path,
+def write_app_state(state_file: str,
                     app_manifest: AppManifest,
                     existing_state: dict = None):
     from ksconf.util.file import atomic_open
@@ -234,13 +235,11 @@ def write_app_state(state_file: Path,
 
     data.setdefault("src_path", None)
     data.setdefault("installed_at", time.time())
-    data.update(src_hash=app_manifest.hash,
-                ansible_module_version=collection_version,
-                ksconf_version=ksconf_version,
-                manifest=app_manifest.to_dict())
-    data["rebuilt_from_filesystem"] = True
-    with atomic_open(state_file, mode="w", temp_name="tmp.sideload") as marker_f:
-        json.dump(data, marker_f, indent=1)
+    data.update(_STATE_CONSTS)
+    data["src_hash"] = app_manifest.hash
+    data["manifest"] = app_manifest.to_dict()
+    with atomic_open(state_file, mode="wb", temp_name="tmp.sideload") as marker_f:
+        marker_f.write(json_dumps(data, pretty=STATE_FILE_PRETTY))
     return data
 
 
@@ -251,9 +250,10 @@ def main():
             state_file=dict(type="path", required=False),
             rebuild_manifest=dict(type=bool, default=False),
             discard_local_app_autogen=dict(type=bool, default=True),
+            hash_only=dict(type=bool, default=False),
             raise_exception=dict(type=bool, default=False),        # Undocumented.  For internal debugging
         ),
-        supports_check_mode=False,
+        supports_check_mode=True,
     )
 
     ksconf_version = check_ksconf_version(module)
@@ -267,30 +267,26 @@ def main():
         # It *should* still work, but your milage may vary
         module.warn(f"ksconf version {ksconf_version} is older than {ksconf_warn_version_text}.")
 
-    app_dir = Path(module.params['app_dir'])
+    app_dir = module.params['app_dir']
     state_file = module.params["state_file"]
     rebuild_manifest = module.params['rebuild_manifest']
     raise_exception = module.params["raise_exception"]
     discard_local_app_autogen = module.params["discard_local_app_autogen"]
+    hash_only = module.params["hash_only"]
 
-    if state_file:
-        state_file = Path(state_file)
-    else:
-        state_file = app_dir / SIDELOAD_STATE_FILE
-
-    if module.check_mode:
-        module.exit_json(msg="Check mode unsupported....  Please finish the implementation!")
+    if not state_file:
+        state_file = os.path.join(app_dir, SIDELOAD_STATE_FILE)
 
     results = {
-        "app_dir": os.fspath(app_dir),
-        "state_file": os.fspath(state_file),
+        "app_dir": app_dir,
+        "state_file": state_file,
     }
-    if not app_dir.is_dir():
+    if not os.path.isdir(app_dir):
         module.fail_json(msg=f"App directory {app_dir} does not exists", result="no-app", **results)
     if not os.access(app_dir, os.R_OK):
         module.fail_json(msg=f"App directory {app_dir} is not readable", result="no-app", **results)
 
-    manifest = state = None
+    manifest = state = manifest_dict = None
     try:
         # Is the state_file missing (only a problem if rebuild_manifest is not present)
         manifest, state, results["state_init"] = get_app_manifest(state_file)
@@ -303,13 +299,20 @@ def main():
     if manifest:
         results["result"] = "loaded"
     else:
-        if rebuild_manifest:
+        if rebuild_manifest and module.check_mode:
+            # Don't walk the app directory just to report that the state file would be updated
+            results["result"] = "check-would-rebuild"
+            results["changed"] = True
+        elif rebuild_manifest:
             # Attempt to build a new manifest
 
-            prev_mod_version = state.get('ansible_module_version', '?')
+            # state is None when the state file is missing or corrupted
+            prev_mod_version = (state or {}).get('ansible_module_version', '?')
             try:
                 manifest = build_app_manifest(app_dir, state_file, discard_local_app_autogen)
                 state = write_app_state(state_file, manifest, state)
+                # Reuse the serialized manifest (state is returned without it, as when loaded)
+                manifest_dict = state.pop("manifest")
                 results["changed"] = True
             except Exception as e:
                 results["result"] = "error"
@@ -333,9 +336,11 @@ def main():
             # No manifest information present; and rebuild is prohibited
             results["result"] = "no-manifest"
 
+    if manifest and hash_only:
+        results["hash"] = manifest.hash
+    elif manifest:
+        results["manifest"] = manifest_dict or manifest.to_dict()
     results["state"] = state
-    if manifest:
-        results["manifest"] = manifest.to_dict()
 
     module.exit_json(**results)
 
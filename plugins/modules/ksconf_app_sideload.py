@@ -7,15 +7,16 @@ from __future__ import absolute_import, division, print_function
 import json
 import os
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path, PurePath
 
 from ansible.module_utils._text import to_bytes, to_native
 from ansible.module_utils.basic import AnsibleModule
 
 from ansible_collections.cdillc.splunk.plugins.module_utils.ksconf_shared import (
-    SIDELOAD_STATE_FILE, __version__ as collection_version,
-    check_ksconf_version)
+    SIDELOAD_STATE_FILE, STATE_FILE_PRETTY, __version__ as collection_version,
+    check_ksconf_version, json_dumps)
 
 
 __metaclass__ = type
@@ -79,11 +80,28 @@ options:
     type: bool
     default: true
     required: false
+  use_facts_cache:
+    description:
+      - Skip the remote manifest check when the C(cdillc_splunk_sideload_<app>) host fact shows that this
+        exact archive has already been deployed to the same location.
+        This fact is set by this module (action) after each successful run.
+      - Facts only live for the duration of the play, unless fact caching is enabled.
+        Disable this if the app could be modified by some other means in the meantime.
+    type: bool
+    default: true
+    required: false
   io_buffer_size:
     description:
       - Size of the volatile memory buffer that is used for extracting files from the archive in bytes.
     type: bytes
     default: 65536
+  extract_concurrency:
+    description:
+      - Number of files to write concurrently when extracting the archive.
+      - Values above 1 can significantly speed up deployment to high latency filesystems, such as NFS,
+        for apps containing many files.  There is no benefit for local disks.
+    type: int
+    default: 1
   list_files:
     description:
       - If set to True, return the list of files that are contained in the tarball.
@@ -149,6 +167,13 @@ notes:
       For this speedup to work, the controller must have write access to the
       parent directory of I(src).
       Also, any tarball created with I(ksconf_package) will already have this manifest file.
+    - When the app is unchanged, only a single (small) module call is made to the target.
+      Enabling Ansible pipelining (C(ANSIBLE_PIPELINING)) avoids creating and removing a remote
+      temporary directory for that call, and SSH connection reuse (C(ControlPersist)) avoids
+      reconnecting for each task.  Both are strongly recommended when deploying many apps.
+    - When deploying to a large number of hosts at once (especially with the C(free) strategy), the
+      controller can spend significant CPU time polling worker processes.  Raising
+      C(ANSIBLE_INTERNAL_POLL_INTERVAL) (e.g., to C(0.01)) can reduce this overhead.
 '''
 
 
@@ -206,6 +231,11 @@ group:
   returned: always
   type: str
   sample: "librarians"
+installed_at:
+  description: Time (in seconds since the epoch) the app was installed, as recorded in the state file.
+  returned: on success
+  type: float
+  sample: 1700000000.123
 mode:
   description: String that represents the octal permissions of the destination directory.
   returned: always
@@ -240,26 +270,118 @@ uid:
   returned: always
   type: int
   sample: 1000
+ansible_facts:
+  description: >
+    Deployment marker fact named C(cdillc_splunk_sideload_<app>), where non-word characters in the app
+    name are replaced by C(_).  Contains C(hash), C(state_file), and C(installed_at) (when known).
+  returned: on success
+  type: dict
 '''
 
 
+# File common arguments that require walking all extracted paths
+FILE_ATTRIBUTE_ARGS = ("mode", "owner", "group", "attributes", "seuser", "serole", "setype", "selevel")
+
+
 def calc_missing_parent_dirs(paths):
     """
-    Given a sequence of paths, return a list of unique parent directories and
-    files in tree creation order.
+    Given a sequence of relative ('/' separated) paths, return a list of unique
+    parent directories (including ".") and files in tree creation order.
     """
-    known_dirs = set()
+    if not paths:
+        return []
+    known_dirs = {"."}
     for path in paths:
-        path = PurePath(path)
-        assert not path.is_absolute(), f"Path {path} is not a relative path!"
-        parent = path.parent
-        while parent not in known_dirs:
+        assert not path.startswith("/"), f"Path {path} is not a relative path!"
+        parent = path.rpartition("/")[0]
+        while parent and parent not in known_dirs:
             known_dirs.add(parent)
-            parent = parent.parent
-    return [os.fspath(p) for p in list(known_dirs) + paths]
+            parent = parent.rpartition("/")[0]
+    # Sorting places each directory before any of its children
+    return sorted(known_dirs) + list(paths)
+
+
+def iter_archive_streams(archive, extract_filter):
+    """
+    Like ``ksconf.archive.extract_archive()``, but yield ``(path, mode, stream)`` for each
+    regular file whose path passes ``extract_filter``, rather than reading every payload
+    into memory.  Each stream must be consumed before advancing to the next member.
+    """
+    archive = os.fspath(archive)
+    if archive.lower().endswith(".zip"):
+        import zipfile
+        with zipfile.ZipFile(archive, mode="r") as zipf:
+            for zi in zipf.infolist():
+                if zi.filename.endswith("/") or not extract_filter(zi.filename):
+                    continue
+                with zipf.open(zi) as stream:
+                    # No modes in zip files; same default as ksconf
+                    yield zi.filename, 0o644, stream
+    else:
+        import tarfile
+        with tarfile.open(archive, "r", encoding="utf-8") as tar:
+            for ti in tar:
+                if ti.isreg() and extract_filter(ti.name):
+                    yield ti.name, ti.mode & 0o777, tar.extractfile(ti)
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _copy_payload(fd, payload, buffer: bytearray = None):
+    if isinstance(payload, (bytes, bytearray)):
+        _write_all(fd, payload)
+    else:
+        view = memoryview(buffer)
+        while True:
+            n = payload.readinto(buffer)
+            if not n:
+                break
+            _write_all(fd, view[:n])
 
 
-def ksconf_sideload_app(src, dest, *, src_orig=None, state_file=None):
+def write_file(path, payload, mode: int, buffer: bytearray = None):
+    """
+    Atomically write ``payload`` to ``path`` and set ``mode``.
+    ``payload`` is either bytes, or a binary stream that is copied through ``buffer``.
+
+    Content is written to a hidden temporary file in the same directory and renamed into place,
+    so splunkd never reads a partially written file.  When replacing an existing file, its owner
+    and group are copied onto the temporary file before the rename.
+    """
+    path = os.fspath(path)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+
+    head, name = os.path.split(path)
+    tmp_path = os.path.join(head, f".{name}.ksconf-tmp-{os.getpid()}")
+    # Raises FileNotFoundError if the parent directory is missing
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        try:
+            _copy_payload(fd, payload, buffer)
+            if st is not None:
+                try:
+                    os.fchown(fd, st.st_uid, st.st_gid)
+                except PermissionError:
+                    # Unprivileged; keep the owner of the new file
+                    pass
+            os.fchmod(fd, mode)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def ksconf_sideload_app(src, dest, *, src_orig=None, state_file=None, extract_concurrency=1,
+                        io_buffer_size=65536):
     try:
         from ksconf.version import version as ksconf_version
     except ImportError:
@@ -276,6 +398,91 @@ def ksconf_sideload_app(src, dest, *, src_orig=None, state_file=None):
             # For right now, we only are dealing with a *single* app, so just always return 'src'
             return src
 
+        def apply_sequence(self, deployment_sequence: DeploySequence):
+            """
+            Apply a pre-calculated deployment sequence to the local file system.
+
+            Unlike the base implementation, unchanged content is never rewritten.  Mode-only
+            ('attr') changes are applied with chmod, and only archive members that must be
+            written are read from the archive.
+            """
+            extract_paths = set()
+            chmod_paths = {}
+            remove_paths = set()
+            app_path = PurePath()
+            archive = None
+            for action in deployment_sequence.actions:
+                if action.action == DeployActionType.EXTRACT_FILE:
+                    path = app_path.joinpath(action.path)
+                    if action.subtype == "attr" and action.mode is not None:
+                        chmod_paths[path] = action.mode
+                    else:
+                        extract_paths.add(path)
+                elif action.action == DeployActionType.SET_APP_NAME:
+                    app_path = PurePath(action.name)
+                elif action.action == DeployActionType.REMOVE_FILE:
+                    remove_paths.add(app_path.joinpath(action.path))
+                elif action.action == DeployActionType.SOURCE_REFERENCE:
+                    archive = self.resolve_source(action.archive_path, action.hash)
+                else:
+                    raise TypeError(f"Unable to handle action of type {type(action)}")
+
+            if not archive:
+                raise TypeError(f"Missing {DeployActionType.SOURCE_REFERENCE} event. "
+                                "Therefore archive is unknown.")
+
+            # Cleanup removed files (avoid corner cases caused by op ordering)
+            for path in remove_paths:
+                full_path = self.dest.joinpath(path)
+                if full_path.is_file():
+                    full_path.unlink()
+
+            for path, mode in chmod_paths.items():
+                try:
+                    self.dest.joinpath(path).chmod(mode)
+                except FileNotFoundError:
+                    # Manifest is out of sync with the filesystem; extract this file after all
+                    extract_paths.add(path)
+
+            # Expand matching files (skip reading all other members)
+            members = iter_archive_streams(archive, lambda name: PurePath(name) in extract_paths)
+            if extract_concurrency > 1:
+                # Writes are independent.  Bound the number of in-flight payloads
+                with ThreadPoolExecutor(extract_concurrency) as executor:
+                    pending = deque()
+                    for path, mode, stream in members:
+                        # Archive streams are sequential; read the payload before handing it off
+                        pending.append(executor.submit(self.write_member, path, stream.read(), mode))
+                        if len(pending) >= extract_concurrency * 2:
+                            pending.popleft().result()
+                    for future in pending:
+                        future.result()
+            else:
+                # Stream each member through a single reused buffer
+                buffer = bytearray(io_buffer_size)
+                for path, mode, stream in members:
+                    self.write_member(path, stream, mode, buffer)
+
+            # Cleanup any empty directories (longest paths first)
+            for d in sorted({p.parent for p in remove_paths}, key=lambda p: (len(p.parts), p), reverse=True):
+                full_path = self.dest.joinpath(d)
+                if full_path.is_dir() and full_path.stat().st_nlink == 2:
+                    try:
+                        full_path.rmdir()
+                    except OSError:
+                        pass
+
+        def write_member(self, path, payload, mode: int, buffer: bytearray = None):
+            """ Write a file, creating parent directories only when missing. """
+            dest_path = self.dest.joinpath(path)
+            try:
+                write_file(dest_path, payload, mode, buffer)
+            except FileNotFoundError:
+                # New directory; parents=True as some directories have no files of their own.
+                # (Nothing has been read from payload yet; opening the temporary file failed)
+                dest_path.parent.mkdir(self.dir_mode, parents=True, exist_ok=True)
+                write_file(dest_path, payload, mode, buffer)
+
     deployer = DeployApply(dest)
 
     app_facts, app_manifest = get_facts_manifest_from_archive(src, calculate_hash=True,
@@ -341,28 +548,29 @@ def ksconf_sideload_app(src, dest, *, src_orig=None, state_file=None):
         if action.action in (DeployActionType.EXTRACT_FILE, DeployActionType.REMOVE_FILE):
             files_changed[str(action.action)].append(os.fspath(action.path))
 
+    data = {
+        "src_path": src_orig or os.fspath(src),
+        "src_hash": app_manifest.hash,
+        "ansible_module_version": collection_version,
+        "ksconf_version": ksconf_version,
+        "installed_at": time.time(),
+        "manifest": app_manifest.to_dict(),
+    }
+    result["installed_at"] = data["installed_at"]
+    payload = json_dumps(data, pretty=STATE_FILE_PRETTY)
+
     try:
         # Added in ksconf v0.11.5
         from ksconf.util.file import atomic_open
-        f_context = atomic_open(state_file, mode="w", temp_name="tmp.sideload")
+        f_context = atomic_open(state_file, mode="wb", temp_name="tmp.sideload")
     except ImportError:
         f_context = open(state_file, "wb")
 
     with f_context as marker_f:
-        data = {
-            "src_path": src_orig or src,
-            "src_hash": app_manifest.hash,
-            "ansible_module_version": collection_version,
-            "ksconf_version": ksconf_version,
-            "installed_at": time.time(),
-            "manifest": app_manifest.to_dict(),
-        }
-        json.dump(data, marker_f, indent=1)
-
-    # Inventory paths are relative to the `dest` directory
-    file_list = [app_manifest.name / f.path for f in app_manifest.files]
-    # Remove non-existent paths (because manifest can be incorrect)
-    file_list = [os.fspath(f) for f in file_list if (dest/f).is_file()]
+        marker_f.write(payload)
+
+    # Inventory paths are relative to the `dest` directory.  (May include non-existent paths)
+    file_list = [os.fspath(app_manifest.name / f.path) for f in app_manifest.files]
 
     # Hard code this for now!
     result["changed"] = True
@@ -377,7 +585,9 @@ def main():
             dest=dict(type='path', required=True),
             state_file=dict(type='path', required=False),
             # show_manifest=dict(type=bool, default=False, alias="list_files")
-            list_files=dict(type='bool', default=False)
+            list_files=dict(type='bool', default=False),
+            extract_concurrency=dict(type='int', default=1),
+            io_buffer_size=dict(type='bytes', default=64 * 1024),
         ),
         add_file_common_args=True,
         # supports_check_mode=True
@@ -424,13 +634,20 @@ def main():
 
     res_args, files, state_file = ksconf_sideload_app(src, dest,
                                                       src_orig=src_orig,
-                                                      state_file=state_file)
+                                                      state_file=state_file,
+                                                      extract_concurrency=module.params["extract_concurrency"],
+                                                      io_buffer_size=module.params["io_buffer_size"])
+
+    set_attrs = any(file_args.get(a, None) for a in FILE_ATTRIBUTE_ARGS)
+    if list_files or set_attrs:
+        # Remove non-existent paths (because manifest can be incorrect)
+        files = [f for f in files if os.path.isfile(os.path.join(dest, f))]
 
     if res_args.get('diff', True) and not module.check_mode:
         # Reset permissions on all files (mode,owner,group,attr,se*)
 
-        # Only apply path changes if mode/owner/group was set
-        if any(file_args.get(a, None) for a in ('mode', 'owner', 'group')):
+        # Only apply path changes if any file attribute was set (skip a stat per file otherwise)
+        if set_attrs:
             # Note:  Inject parent directories into the list as directories aren't in the manifest
             for filename in calc_missing_parent_dirs(files):
                 file_args['path'] = os.path.join(b_dest, to_bytes(
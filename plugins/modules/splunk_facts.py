@@ -4,7 +4,6 @@
 from __future__ import absolute_import, division, print_function
 
 import hashlib
-import json
 import os
 import re
 from pathlib import Path
@@ -12,7 +11,7 @@ from pathlib import Path
 from ansible.module_utils.basic import AnsibleModule
 
 from ansible_collections.cdillc.splunk.plugins.module_utils.ksconf_shared import (
-    SIDELOAD_STATE_FILE, find_splunk_home)
+    SIDELOAD_STATE_FILE, find_splunk_home, json_loads)
 
 
 __metaclass__ = type
@@ -467,13 +466,16 @@ class SplunkMetadata(object):
                     from ksconf.app.facts import AppFacts
                     af = AppFacts.from_app_dir(app_path)
                     info["app_conf"] = af.to_tiny_dict("name", "author", "version")
-                    del af
 
                 if True:
                     state_file = app_path / SIDELOAD_STATE_FILE
-                    if state_file.is_file():
-                        with open(state_file) as fp:
-                            data = json.load(fp)
+                    try:
+                        with open(state_file, "rb") as fp:
+                            data = json_loads(fp.read())
+                    except OSError:
+                        # Missing, a directory, or unreadable; skip as is_file() used to
+                        data = None
+                    if data is not None:
                         try:
                             if len(data["manifest"]["files"]) > max_manifest_length:
                                 data["manifest"]["files"] = len(data["manifest"]["files"])